@@ -4,13 +4,18 @@
 The script is completely configured with a YAML file and executed as follows
 
 ```
-backup.py CONFIG [-n] [-s]
+backup.py CONFIG [-n] [-s] [-q] [-c]
 ```
 
 The option `-n` will result in a dry run, which can be used to check the configuration.
 
 The option `-s` skips the creation of a new snapshot, useful to retry after a failed borg backup.
 
+The option `-q` only shows the output of the BTRFS and Borg commands.
+
+The option `-c` keeps a JSON copy of the config next to the YAML file (`CONFIG.json`),
+which is loaded instead of the YAML file as long as the latter is not modified.
+
 
 The config file has the following format:
 
@@ -21,6 +26,7 @@ keep_hourly: 48  # Number of hourly snapshots that are kept
 keep_daily: 14  # Number of daily snapshots that are kept
 keep_weekly: 20  # Number of weekly snapshots that are kept
 keep_monthly: 12  # Number of monthly snapshots that are kept
+# A negative number keeps all snapshots of the corresponding timeline.
 
 btrfs:
   uuid: '' # UUID of btrfs disk
@@ -34,26 +40,58 @@ btrfs:
 borg:
   prefix: '' # Prefix used for archive names
   env: {} # Dictionary with environment variables set for each Borg command.
+  # E.g. BORG_CACHE_DIR can be set to keep the Borg cache on a persistent location.
   extra: [] # Extra arguments for borg in list format
   paths: [] # Paths inside the subvolume to back up
   repositories: [] # List of borg repositories to where snapshots are backed up.
   # If you prefer to skip the borg backup, leave the list of repositories empty.
 ```
 
+When the Python bindings of libbtrfsutil (`btrfsutil`) are installed,
+BTRFS snapshots are listed, created and deleted without calling the `btrfs` command.
+Otherwise, the script falls back to the `btrfs` command-line tool.
+
+The parsed config file is cached in `$XDG_CACHE_HOME/backup-script` (default `~/.cache`),
+so the YAML file is only parsed again after it has been modified.
+
 """
 
 import argparse
+import concurrent.futures
+import contextlib
+import ctypes
+import functools
+import hashlib
+import json
 import logging
 import os
+import re
 import signal
 import subprocess
 import sys
+from collections.abc import Iterator
 from datetime import datetime
 from time import sleep
 
 import yaml
 
+try:
+    import btrfsutil
+except ImportError:
+    btrfsutil = None
+
 LOGGER = logging.getLogger(__name__)
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+DEFAULT_DATETIME_FORMAT = "%Y_%m_%d__%H_%M_%S"
+DATETIME_DIRECTIVES = {
+    "%Y": r"(?P<year>\d{4})",
+    "%m": r"(?P<month>\d{1,2})",
+    "%d": r"(?P<day>\d{1,2})",
+    "%H": r"(?P<hour>\d{1,2})",
+    "%M": r"(?P<minute>\d{1,2})",
+    "%S": r"(?P<second>\d{1,2})",
+    "%%": "%",
+}
 
 
 def grandfatherson(
@@ -92,44 +130,48 @@ def grandfatherson(
     Notes
     -----
     The most recent date is always kept.
+    A negative number of snapshots for a timeline keeps all snapshots along that timeline.
     For more info on the GFS algorithm, see:
     https://en.wikipedia.org/wiki/Backup_rotation_scheme#Grandfather-father-son
     """
+    if len(dts) == 0:
+        return [], []
     dts = sorted(dts, reverse=True)
-    keep_flags = [False] * len(dts)
-    # Always keep the most recent.
-    keep_flags[0] = True
+    # Bit i of keep is set when dts[i] should be kept. Always keep the most recent.
+    keep = 1
 
+    # All labels, except the weekly ones, are prefixes of the ten-minutely label.
+    base_labels = [dt.strftime("%Y-%m-%d-%H-%M") for dt in dts]
+    weekly_labels = [dt.strftime("%Y-%W") for dt in dts] if weekly != 0 else []
     timelines = [
-        ("%Y-%m-%d-%H-%M", tenminutely, 1),
-        ("%Y-%m-%d-%H", hourly, 0),
-        ("%Y-%m-%d", daily, 0),
-        ("%Y-%W", weekly, 0),
-        ("%Y-%m", monthly, 0),
+        (base_labels, tenminutely, 1),
+        (base_labels, hourly, 3),
+        (base_labels, daily, 6),
+        (weekly_labels, weekly, 0),
+        (base_labels, monthly, 9),
     ]
 
-    for fmt, need, drop in timelines:
+    for labels, need, drop in timelines:
         if need == 0:
             continue
         # We're keeping the most recent one, but don't include it in the counts
         have = 0
-        labels = [dt.strftime(fmt) for dt in dts]
-        if drop > 0:
-            labels = [label[:-drop] for label in labels]
+        limit = need + 1 if need > 0 else len(dts)
+        stop = -drop or None
         for i in range(len(labels) - 1):
-            if labels[i] != labels[i + 1]:
-                keep_flags[i] = True
+            if labels[i][:stop] != labels[i + 1][:stop]:
+                keep |= 1 << i
                 have += 1
-                if have > need or need < 0:
+                if have == limit:
                     break
         # Always keep the last one when we don't have enough.
-        if need > 0 and have < need:
-            keep_flags[-1] = True
+        if need < 0 or have < need:
+            keep |= 1 << (len(dts) - 1)
 
     keep_dts = []
     prune_dts = []
-    for keep, dt in zip(keep_flags, dts, strict=False):
-        if keep:
+    for i, dt in enumerate(dts):
+        if keep >> i & 1:
             keep_dts.append(dt)
         else:
             prune_dts.append(dt)
@@ -161,6 +203,13 @@ def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
         action="store_true",
         help="Only show output of BTRFS and Borg commands.",
     )
+    parser.add_argument(
+        "-c",
+        "--cache-config",
+        default=False,
+        action="store_true",
+        help="Keep a JSON copy of the config file, used instead of the YAML file until it changes.",
+    )
     return parser.parse_args(argv)
 
 
@@ -175,86 +224,211 @@ def main(argv: list[str] | None = None):
     )
 
     # Load yaml config file
-    with open(args.config, encoding="utf-8") as f:
-        config = yaml.safe_load(f)
+    config = load_config(args.config, args.cache_config)
 
     # Work on the btrfs part
-    subvol_new = None if args.skip_snapshot else _create_btrfs_snapshot(config, args.dry_run)
-    snapshots = _prune_old_btrfs_snapshots(config, args.dry_run, args.skip_snapshot, subvol_new)
+    new = None if args.skip_snapshot else _create_btrfs_snapshot(config, args.dry_run)
+    snapshots = _prune_old_btrfs_snapshots(config, args.dry_run, new)
 
     # Work on the borg part
-    env = config["borg"].get("env", {})
-    for repository in config["borg"]["repositories"]:
-        if not _check_borg_repository(repository, env):
-            LOGGER.info("Could not access %s", repository)
-            continue
-        archives = _get_borg_archives(config, repository, env)
+    # The full environment of the Borg commands is the same for all repositories.
+    env = os.environ | config["borg"].get("env", {})
+    # The repositories are independent, so they are listed and pruned concurrently.
+    repositories = config["borg"]["repositories"]
+    with concurrent.futures.ThreadPoolExecutor(max(len(repositories), 1)) as executor:
+        futures = {
+            repository: executor.submit(_get_borg_archives, config, repository, env)
+            for repository in repositories
+        }
+        all_archives = {}
+        for repository, future in futures.items():
+            # Listing the archives also checks that the repository is accessible.
+            try:
+                all_archives[repository] = future.result()
+            except subprocess.CalledProcessError:
+                LOGGER.info("Could not access %s", repository)
+
+        # Each snapshot is mounted once to create the missing archives in all repositories.
+        LOGGER.info("Creating new borg archives")
+        dts_create = {
+            repository: snapshots.keys() - archives.keys()
+            for repository, archives in all_archives.items()
+        }
+        for dt in sorted(set().union(*dts_create.values())):
+            repositories_create = [
+                repository for repository, dts in dts_create.items() if dt in dts
+            ]
+            _create_borg_archives(config, args.dry_run, repositories_create, env, snapshots[dt])
+
+        futures = []
+        for repository, archives in all_archives.items():
+            LOGGER.info("Pruning old archives if any (%s)", repository)
+            archives_prune = [archives[dt] for dt in sorted(archives.keys() - snapshots.keys())]
+            futures.append(
+                executor.submit(
+                    _prune_old_borg_archives, args.dry_run, repository, env, archives_prune
+                )
+            )
+        for future in futures:
+            future.result()
+
+
+def load_config(path: str, sidecar: bool = False) -> dict[str]:
+    """Load the YAML config file, reusing a cached copy if the file has not changed.
+
+    Parameters
+    ----------
+    path
+        The YAML config file.
+    sidecar
+        When True, a JSON copy of the config is kept next to the YAML file (with an
+        additional `.json` extension), and it is used instead of the YAML file
+        when it is not older than the YAML file.
+
+    Returns
+    -------
+    config
+        The parsed config.
+
+    Notes
+    -----
+    The cache contains one JSON file per config path,
+    with the parsed config and the SHA256 hash of the contents of the config file.
+    Failures to read or write the cache are not fatal: the YAML file is parsed instead.
+    """
+    fn_json = f"{path}.json"
+    if sidecar:
+        try:
+            if os.path.getmtime(fn_json) >= os.path.getmtime(path):
+                with open(fn_json, encoding="utf-8") as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    # An empty or relative XDG_CACHE_HOME must be ignored.
+    dn_cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not dn_cache_home or not os.path.isabs(dn_cache_home):
+        dn_cache_home = os.path.expanduser("~/.cache")
+    dn_cache = os.path.join(dn_cache_home, "backup-script")
+    path_digest = hashlib.sha256(os.fsencode(os.path.realpath(path))).hexdigest()
+    fn_cache = os.path.join(dn_cache, path_digest + ".json")
+    try:
+        os.makedirs(dn_cache, mode=0o700, exist_ok=True)
+        use_cache = _is_private(os.stat(dn_cache))
+    except OSError:
+        use_cache = False
+    if not use_cache:
+        LOGGER.info("Not using config cache %s", dn_cache)
+    config = _read_config_cache(fn_cache, digest) if use_cache else None
+    if config is None:
+        config = yaml.load(data.decode("utf-8"), Loader=YAML_LOADER)
+        try:
+            text = json.dumps({"sha256": digest, "config": config})
+        except (TypeError, ValueError):
+            LOGGER.info("Config cannot be cached as JSON: %s", path)
+        else:
+            # Return the same result as when the cache is used later.
+            config = json.loads(text)["config"]
+            if use_cache:
+                try:
+                    _write_atomic(fn_cache, text.encode("utf-8"))
+                except OSError:
+                    LOGGER.info("Could not write config cache %s", fn_cache)
+
+    if sidecar:
+        try:
+            # The JSON file is as private as the YAML file.
+            _write_atomic(
+                fn_json,
+                json.dumps(config, indent=2).encode("utf-8"),
+                os.stat(path).st_mode & 0o777,
+            )
+        except (OSError, TypeError, ValueError):
+            LOGGER.info("Could not write config cache %s", fn_json)
+    return config
 
-        LOGGER.info("Creating new borg archives (%s)", repository)
-        for dt_keep, subvol in snapshots.items():
-            if dt_keep in archives:
-                continue
-            _create_borg_archive(config, args.dry_run, repository, env, subvol)
 
-        LOGGER.info("Pruning old archives if any (%s)", repository)
-        removed = _prune_old_borg_archives(args.dry_run, repository, env, snapshots, archives)
-        if removed:
-            _compact_borg_repository(args.dry_run, repository, env)
+def _read_config_cache(fn_cache: str, digest: str) -> dict[str] | None:
+    """Return the cached config, or None if it is missing, damaged or outdated."""
+    try:
+        with open(fn_cache, encoding="utf-8") as f:
+            if not _is_private(os.fstat(f.fileno())):
+                LOGGER.info("Ignoring config cache %s", fn_cache)
+                return None
+            cache = json.load(f)
+        if cache["sha256"] == digest:
+            return cache["config"]
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+    return None
+
+
+def _is_private(st: os.stat_result) -> bool:
+    """Check that a file is owned by the current user and cannot be modified by others.
+
+    The config may contain secrets and commands executed as root,
+    so a cached copy is only trusted when nobody else can have written it.
+    """
+    return st.st_uid == os.geteuid() and not st.st_mode & 0o022
+
 
+def _write_atomic(path: str, data: bytes, mode: int = 0o600):
+    """Write a file through a temporary file, such that readers never see a partial file.
 
-def _create_btrfs_snapshot(config: dict[str], dry_run: bool) -> str:
-    """Create a new BTRFS snapshot."""
+    The file is created with the given permission bits (subject to the umask),
+    so it is never readable by others while it is being written.
+    """
+    fn_tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(fn_tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, mode)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(fn_tmp, path)
+    except BaseException:
+        os.unlink(fn_tmp)
+        raise
+
+
+def _create_btrfs_snapshot(config: dict[str], dry_run: bool) -> tuple[datetime, str]:
+    """Create a new BTRFS snapshot and return its datetime and subvolume."""
     try:
         LOGGER.info("Preparing for snapshot")
         for split_args in config["btrfs"]["pre"]:
             run(split_args, dry_run)
 
         LOGGER.info("Making a new snapshot")
-        suffix_new = datetime.now().strftime(config["datetime_format"])
+        # Same precision as the datetimes parsed from the snapshot names.
+        dt_new = truncate_datetime(datetime.now(), config["datetime_format"])
+        suffix_new = dt_new.strftime(config["datetime_format"])
         subvol_new = config["btrfs"]["prefix"] + suffix_new
         dn_new = config["btrfs"]["mount"] + subvol_new
-        run(
-            [
-                "btrfs",
-                "subvolume",
-                "snapshot",
-                "-r",
-                config["btrfs"]["mount"] + config["btrfs"]["source"],
-                dn_new,
-            ],
-            dry_run,
+        _snapshot_btrfs_subvolume(
+            config["btrfs"]["mount"] + config["btrfs"]["source"], dn_new, dry_run
         )
     finally:
         LOGGER.info("Cleaning after snapshot")
         for split_args in config["btrfs"]["post"]:
             run(split_args, dry_run)
-    return subvol_new
+    return dt_new, subvol_new
 
 
 def _prune_old_btrfs_snapshots(
-    config: dict[str], dry_run: bool, skip_snapshot: bool, subvol_new: str
+    config: dict[str], dry_run: bool, new: tuple[datetime, str] | None
 ) -> dict[datetime, str]:
     """Delete old BTRFS snapshots using the GFS algorithm."""
     LOGGER.info("Pruning old snapshots")
     # Loop over existing snapshots, derive dates and keep a dictionary.
     snapshots = {}
-    output = run(["btrfs", "subvolume", "list", config["btrfs"]["mount"]], capture=True)
-    for line in output.split("\n"):
-        words = line.split()
-        if len(words) == 0:
-            continue
-        subvol = words[-1]
-        if not subvol.startswith(config["btrfs"]["prefix"]):
-            continue
+    for subvol in _list_btrfs_subvolumes(config["btrfs"]["mount"], config["btrfs"]["prefix"]):
         dt = parse_suffix(subvol[len(config["btrfs"]["prefix"]) :], config["datetime_format"])
         snapshots[dt] = subvol
 
     # Add new a snapshot in case of dry run.
-    if dry_run and not skip_snapshot:
-        # Overwrite dt_new with the parsed one for consistency
-        dt_new = parse_suffix(
-            subvol_new[len(config["btrfs"]["prefix"]) :], config["datetime_format"]
-        )
+    if dry_run and new is not None:
+        dt_new, subvol_new = new
         snapshots[dt_new] = subvol_new
 
     # Determine which snapshots to prune.
@@ -269,27 +443,50 @@ def _prune_old_btrfs_snapshots(
 
     # Execute subvolume deletion commands
     for dt in dts_prune:
-        run(
-            [
-                "btrfs",
-                "subvolume",
-                "delete",
-                config["btrfs"]["mount"] + snapshots[dt],
-            ],
-            dry_run,
-        )
+        _delete_btrfs_subvolume(config["btrfs"]["mount"] + snapshots[dt], dry_run)
         del snapshots[dt]
 
     return snapshots
 
 
-def _check_borg_repository(repository: str, env: dict[str, str]) -> bool:
-    """Get basic info from a borg repository."""
-    try:
-        run(["borg", "info", repository], env=os.environ | env)
-    except subprocess.CalledProcessError:
-        return False
-    return True
+def _snapshot_btrfs_subvolume(source: str, dn_new: str, dry_run: bool):
+    """Create a read-only snapshot of a BTRFS subvolume."""
+    if btrfsutil is None:
+        run(["btrfs", "subvolume", "snapshot", "-r", source, dn_new], dry_run)
+    elif dry_run:
+        LOGGER.info("Skipping btrfsutil.create_snapshot %s %s", source, dn_new)
+    else:
+        LOGGER.info("Running btrfsutil.create_snapshot %s %s", source, dn_new)
+        btrfsutil.create_snapshot(source, dn_new, read_only=True)
+
+
+def _list_btrfs_subvolumes(mount: str, prefix: str) -> Iterator[str]:
+    """List the paths of subvolumes starting with a prefix, relative to the BTRFS mount point."""
+    if btrfsutil is None:
+        # Match the last word of each line, if it starts with the prefix.
+        pattern = re.compile(rb"(?:^|\s)(?=\S)(" + re.escape(prefix.encode()) + rb"\S*)\s*$")
+        lines = run_lines(["btrfs", "subvolume", "list", mount], grep=f" {prefix}", encoding=None)
+        for line in lines:
+            match = pattern.search(line)
+            if match is not None:
+                yield match.group(1).decode()
+        return
+    LOGGER.info("Running btrfsutil.SubvolumeIterator %s", mount)
+    with btrfsutil.SubvolumeIterator(mount) as it:
+        for path, _ in it:
+            if path.startswith(prefix):
+                yield path
+
+
+def _delete_btrfs_subvolume(dn_old: str, dry_run: bool):
+    """Delete a BTRFS subvolume."""
+    if btrfsutil is None:
+        run(["btrfs", "subvolume", "delete", dn_old], dry_run)
+    elif dry_run:
+        LOGGER.info("Skipping btrfsutil.delete_subvolume %s", dn_old)
+    else:
+        LOGGER.info("Running btrfsutil.delete_subvolume %s", dn_old)
+        btrfsutil.delete_subvolume(dn_old)
 
 
 def _get_borg_archives(
@@ -298,16 +495,18 @@ def _get_borg_archives(
     """Get a list of archives in the Borg repository."""
     LOGGER.info("Getting a list of borg archives (%s)", repository)
     prefix = config["borg"]["prefix"]
-    output = run(["borg", "list", repository], env=(os.environ | env), capture=True)
+    # Match the first word of each line (the archive name) and the part after the prefix.
+    pattern = re.compile(rb"\s*(" + re.escape(prefix.encode()) + rb"(\S*))")
     archives = {}
-    for line in output.split("\n"):
-        words = line.strip().split()
-        if len(words) == 0:
+    for line in run_lines(["borg", "list", repository], env=env, encoding=None):
+        if line.isspace():
             continue
-        archive = words[0]
-        if not archive.startswith(prefix):
+        match = pattern.match(line)
+        if match is None:
+            archive = line.split()[0].decode()
             raise AssertionError(f"Archive '{archive}' has the wrong prefix. Should be '{prefix}'")
-        dt = parse_suffix(archive[len(prefix) :], config["datetime_format"])
+        archive = match.group(1).decode()
+        dt = parse_suffix(match.group(2).decode(), config["datetime_format"])
         archives[dt] = archive
     return archives
 
@@ -316,25 +515,18 @@ def _prune_old_borg_archives(
     dry_run: bool,
     repository: str,
     env: dict[str, str],
-    snapshots: dict[datetime, str],
-    archives: dict[datetime, str],
-) -> bool:
-    """Delete old Bort archives using the GFS algorithm."""
+    archives_prune: list[str],
+):
+    """Delete old Borg archives, for which the BTRFS snapshots were pruned.
+
+    All archives are deleted with a single Borg command,
+    directly followed by compacting the repository.
+    """
     LOGGER.info("Removing old borg archives (%s)", repository)
-    removed = False
-    for dt, archive in archives.items():
-        if dt not in snapshots:
-            removed = True
-            run(
-                [
-                    "borg",
-                    "delete",
-                    f"{repository}::{archive}",
-                ],
-                dry_run,
-                env=(os.environ | env),
-            )
-    return removed
+    if len(archives_prune) == 0:
+        return
+    run(["borg", "delete", repository, *archives_prune], dry_run, env=env)
+    _compact_borg_repository(dry_run, repository, env)
 
 
 def _compact_borg_repository(dry_run: bool, repository: str, env: dict[str, str]):
@@ -347,17 +539,22 @@ def _compact_borg_repository(dry_run: bool, repository: str, env: dict[str, str]
             repository,
         ],
         dry_run,
-        env=(os.environ | env),
+        env=env,
     )
 
 
-def _create_borg_archive(
-    config: dict[str], dry_run: bool, repository: str, env: dict[str, str], subvol: str
+def _create_borg_archives(
+    config: dict[str], dry_run: bool, repositories: list[str], env: dict[str, str], subvol: str
 ):
-    """Create a Borg backup from a BTRFS snapshot."""
+    """Create Borg backups from a BTRFS snapshot in several repositories.
+
+    The snapshot is mounted once and the Borg commands for all repositories run concurrently.
+    """
     dn_current = config["btrfs"]["mount"] + config["btrfs"]["prefix"] + "current"
     if os.path.isdir(dn_current):
-        run(["umount", dn_current], dry_run, check=False)
+        # Clean up after a previous run that was interrupted.
+        if _is_mounted(dn_current):
+            _umount(dn_current, dry_run)
     else:
         LOGGER.info("Creating directory %s", dn_current)
         os.makedirs(dn_current)
@@ -377,49 +574,137 @@ def _create_borg_archive(
         suffix = subvol[len(config["btrfs"]["prefix"]) :]
         dt = parse_suffix(suffix, config["datetime_format"])
         timestamp = dt.isoformat()
-        run(
+        run_parallel(
             [
-                "borg",
-                "create",
-                "--verbose",
-                "--stats",
-                "--show-rc",
-                "--timestamp",
-                timestamp,
-            ]
-            + config["borg"]["extra"]
-            + [
-                f"{repository}::{config['borg']['prefix']}{suffix}",
-            ]
-            + paths,
+                [
+                    "borg",
+                    "create",
+                    "--verbose",
+                    "--stats",
+                    "--show-rc",
+                    "--timestamp",
+                    timestamp,
+                ]
+                + config["borg"]["extra"]
+                + [
+                    f"{repository}::{config['borg']['prefix']}{suffix}",
+                ]
+                + paths
+                for repository in repositories
+            ],
             dry_run,
-            env=(os.environ | env),
+            env=env,
             cwd=dn_current,
         )
     finally:
         # It may take some time before the disk is no longer considered "in use".
         sleep(1.0)
-        run(["umount", dn_current], dry_run)
+        _umount(dn_current, dry_run)
         LOGGER.info("Removing %s", dn_current)
         os.rmdir(dn_current)
 
 
+def _is_mounted(path: str) -> bool:
+    """Check in /proc/self/mountinfo whether a directory is a mount point."""
+    # Mount points in mountinfo are resolved paths of arbitrary bytes,
+    # with some characters octal-escaped.
+    path = os.fsencode(os.path.realpath(path))
+    for char in b"\\ \t\n":
+        path = path.replace(bytes([char]), b"\\%03o" % char)
+    with open("/proc/self/mountinfo", "rb") as f:
+        return any(line.split()[4] == path for line in f)
+
+
+@functools.cache
+def _get_libc() -> ctypes.CDLL:
+    """Load the C library, for system calls not available in the os module."""
+    return ctypes.CDLL(None, use_errno=True)
+
+
+def _umount(path: str, dry_run: bool):
+    """Unmount a directory, with the umount2 system call when running as root.
+
+    The umount command is used as a fallback, e.g. when not running as root.
+    """
+    if os.geteuid() == 0 and not dry_run:
+        LOGGER.info("Running umount2 %s", path)
+        if _get_libc().umount2(os.fsencode(path), 0) == 0:
+            return
+        LOGGER.info("umount2 failed: %s", os.strerror(ctypes.get_errno()))
+    run(["umount", path], dry_run)
+
+
+@functools.cache
+def _compile_datetime_format(datetime_format: str) -> re.Pattern | None:
+    """Translate a datetime format into a regular expression.
+
+    None is returned when the format contains directives not in DATETIME_DIRECTIVES,
+    or when it does not contain at least the year, month and day.
+    """
+    parts = []
+    for token in re.split("(%.)", datetime_format):
+        if token.startswith("%"):
+            if token not in DATETIME_DIRECTIVES:
+                return None
+            parts.append(DATETIME_DIRECTIVES[token])
+        else:
+            parts.append(re.escape(token))
+    try:
+        pattern = re.compile("".join(parts), re.ASCII)
+    except re.error:
+        # E.g. due to repeated directives.
+        return None
+    if not {"year", "month", "day"} <= pattern.groupindex.keys():
+        return None
+    return pattern
+
+
 def parse_suffix(suffix: str, datetime_format: str) -> datetime:
     """Extract the datetime object from the suffix of an archive directory."""
-    return datetime.strptime(suffix, datetime_format)
+    if datetime_format == DEFAULT_DATETIME_FORMAT and len(suffix) == 20:
+        # Fast path: all fields have a fixed position.
+        fields = [suffix[0:4], suffix[5:7], suffix[8:10], suffix[12:14], suffix[15:17], suffix[18:]]
+        separators = suffix[4] + suffix[7] + suffix[10:12] + suffix[14] + suffix[17]
+        if separators == "______" and all(field.isdigit() for field in fields):
+            return datetime(*map(int, fields))
+    pattern = _compile_datetime_format(datetime_format)
+    if pattern is None:
+        return datetime.strptime(suffix, datetime_format)
+    match = pattern.fullmatch(suffix)
+    if match is None:
+        raise ValueError(f"time data {suffix!r} does not match format {datetime_format!r}")
+    return datetime(**{key: int(value) for key, value in match.groupdict().items()})
+
+
+def truncate_datetime(dt: datetime, datetime_format: str) -> datetime:
+    """Reset the fields of a datetime that are not represented in the datetime format.
+
+    The result is equal to parsing the datetime after formatting it.
+    """
+    pattern = _compile_datetime_format(datetime_format)
+    if pattern is None:
+        return datetime.strptime(dt.strftime(datetime_format), datetime_format)
+    return datetime(**{field: getattr(dt, field) for field in pattern.groupindex})
+
+
+def _log_command(action: str, cmd: list[str], cwd: str | None = None):
+    """Log a command, without formatting it when the message would not be shown."""
+    if not LOGGER.isEnabledFor(logging.INFO):
+        return
+    if cwd is None:
+        LOGGER.info("%s %s", action, " ".join(cmd))
+    else:
+        LOGGER.info("%s %s  # in %s", action, " ".join(cmd), cwd)
 
 
 def run(
     cmd: list[str], dry_run: bool = False, check: bool = True, capture: bool = False, **kwargs
 ) -> str:
     """Print and run a command."""
-    cmd_info = " ".join(cmd)
-    if "cwd" in kwargs:
-        cmd_info = f"{cmd_info}  # in {kwargs['cwd']}"
     if dry_run:
-        LOGGER.info("Skipping %s", cmd_info)
+        _log_command("Skipping", cmd, kwargs.get("cwd"))
         return ""
-    LOGGER.info("Running %s", cmd_info)
+    _log_command("Running", cmd, kwargs.get("cwd"))
     # Make sure output is written in correct order.
     sys.stdout.flush()
 
@@ -430,16 +715,98 @@ def run(
         kwargs["universal_newlines"] = True
     if capture:
         kwargs["stdout"] = subprocess.PIPE
+    output = None
     with subprocess.Popen(cmd, **kwargs) as process:
         try:
-            process.wait()
+            # Unlike wait(), communicate() also reads the captured output while waiting,
+            # so the command cannot block on a full pipe.
+            output, _ = process.communicate()
         except KeyboardInterrupt:
             process.send_signal(signal.SIGINT)
         if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, output)
+    return output or ""
+
+
+def run_parallel(cmds: list[list[str]], dry_run: bool = False, check: bool = True, **kwargs):
+    """Print and run commands concurrently, and wait until all of them have finished.
+
+    When check is True and some commands fail, an exception is raised for the first one.
+    """
+    if dry_run:
+        for cmd in cmds:
+            _log_command("Skipping", cmd, kwargs.get("cwd"))
+        return
+    for cmd in cmds:
+        _log_command("Running", cmd, kwargs.get("cwd"))
+    # Make sure output is written in correct order.
+    sys.stdout.flush()
+
+    if "stdin" not in kwargs:
+        kwargs["stdin"] = subprocess.DEVNULL
+    with contextlib.ExitStack() as stack:
+        processes = [stack.enter_context(subprocess.Popen(cmd, **kwargs)) for cmd in cmds]
+        try:
+            for process in processes:
+                process.wait()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.send_signal(signal.SIGINT)
+    if check:
+        for cmd, process in zip(cmds, processes, strict=True):
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+def run_lines(
+    cmd: list[str], check: bool = True, grep: str | None = None, **kwargs
+) -> Iterator[str | bytes]:
+    """Print and run a command, yielding its standard output line by line.
+
+    The output is not buffered as a whole, so the command may produce a long listing.
+    When grep is given, only lines containing this fixed string are yielded.
+    These are selected by piping the output through grep, so other lines never reach Python.
+    """
+    # With --text, grep does not drop matching lines that are invalid in the current locale.
+    grep_cmd = None if grep is None else ["grep", "--text", "-F", "--", grep]
+    _log_command("Running", cmd if grep_cmd is None else [*cmd, "|", *grep_cmd], kwargs.get("cwd"))
+    # Make sure output is written in correct order.
+    sys.stdout.flush()
+
+    if "stdin" not in kwargs:
+        kwargs["stdin"] = subprocess.DEVNULL
+    if "encoding" not in kwargs:
+        kwargs["encoding"] = "utf-8"
+        kwargs["universal_newlines"] = True
+    with contextlib.ExitStack() as stack:
+        process = stack.enter_context(subprocess.Popen(cmd, stdout=subprocess.PIPE, **kwargs))
+        processes = [process]
+        if grep_cmd is not None:
+            grep_process = stack.enter_context(
+                subprocess.Popen(
+                    grep_cmd,
+                    stdin=process.stdout,
+                    stdout=subprocess.PIPE,
+                    encoding=kwargs["encoding"],
+                )
+            )
+            # Only grep reads the pipe, so cmd gets SIGPIPE if grep exits early.
+            process.stdout.close()
+            processes.append(grep_process)
+        yield from processes[-1].stdout
+        try:
+            for other in processes:
+                other.wait()
+        except KeyboardInterrupt:
+            for other in processes:
+                other.send_signal(signal.SIGINT)
+    if check:
+        # The exit code of grep is 1 when no lines are selected.
+        # A failure of grep is reported first, because cmd may then have died of SIGPIPE.
+        if grep_cmd is not None and grep_process.returncode > 1:
+            raise subprocess.CalledProcessError(grep_process.returncode, grep_cmd)
+        if process.returncode != 0:
             raise subprocess.CalledProcessError(process.returncode, cmd)
-        if capture:
-            return process.stdout.read()
-    return ""
 
 
 if __name__ == "__main__":
@@ -1,126 +1,419 @@
 """Unit tests for the backup sript."""
 
+import json
+import os
+import re
+import subprocess
+from collections.abc import Iterable
 from datetime import datetime
 
-from backup import grandfatherson
-
-
-def test_grandfatherson_none():
-    dts = [
-        datetime(2022, 5, 5, 0, 0, 0),
-        datetime(2022, 5, 4, 0, 0, 0),
-        datetime(2022, 5, 2, 0, 0, 0),
-        datetime(2022, 5, 1, 0, 0, 0),
-    ]
-    assert grandfatherson(dts) == (dts[:1], dts[1:])
-
-
-def test_grandfatherson_tenminutely():
-    dts = [
-        datetime(2022, 5, 5, 17, 30, 0),
-        datetime(2022, 5, 5, 17, 25, 0),
-        datetime(2022, 5, 5, 17, 20, 0),
-        datetime(2022, 5, 5, 16, 55, 0),
-        datetime(2022, 5, 5, 16, 50, 0),
-        datetime(2022, 5, 5, 16, 40, 0),
-        datetime(2022, 5, 5, 16, 30, 0),
-    ]
-    keep_dts = [dts[0], dts[2], dts[4], dts[5]]
-    prune_dts = [dts[1], dts[3], dts[6]]
-    assert grandfatherson(dts, tenminutely=3) == (keep_dts, prune_dts)
-
-
-def test_grandfatherson_hourly():
-    dts = [
-        datetime(2022, 5, 8, 0, 0, 0),
-        datetime(2022, 5, 5, 17, 0, 0),
-        datetime(2022, 5, 5, 16, 30, 0),
-        datetime(2022, 5, 5, 16, 0, 0),
-        datetime(2022, 5, 5, 15, 0, 0),
-    ]
-    keep_dts = [dts[0], dts[1], dts[3]]
-    prune_dts = [dts[2], dts[4]]
-    assert grandfatherson(dts, hourly=3) == (keep_dts, prune_dts)
-
-
-def test_grandfatherson_daily1():
-    dts = [
-        datetime(2022, 5, 5, 0, 0, 0),
-        datetime(2022, 5, 4, 0, 0, 0),
-        datetime(2022, 5, 2, 0, 0, 0),
-        datetime(2022, 5, 1, 0, 0, 0),
-    ]
-    assert grandfatherson(dts, daily=3) == (dts[:-1], dts[-1:])
-
-
-def test_grandfatherson_daily2():
-    dts = [
-        datetime(2022, 5, 5, 10, 0, 0),
-        datetime(2022, 5, 4, 10, 0, 0),
-        datetime(2022, 5, 4, 9, 0, 0),
-        datetime(2022, 5, 2, 10, 0, 0),
-        datetime(2022, 5, 1, 10, 0, 0),
-    ]
-    keep_dts = [dts[0], dts[2], dts[3]]
-    prune_dts = [dts[1], dts[4]]
-    assert grandfatherson(dts, daily=3) == (keep_dts, prune_dts)
-
-
-def test_grandfatherson_daily_too_few():
-    dts = [
-        datetime(2022, 5, 5, 0, 0, 0),
-        datetime(2022, 5, 4, 0, 0, 0),
-    ]
-    assert grandfatherson(dts, daily=3) == (dts[:2], [])
-
-
-def test_grandfatherson_daily_too_few_oldest1():
-    dts = [
-        datetime(2022, 5, 5, 10, 0, 0),
-        datetime(2022, 5, 4, 10, 0, 0),
-        datetime(2022, 5, 4, 9, 0, 0),
-    ]
-    keep_dts = [dts[0], dts[2]]
-    prune_dts = [dts[1]]
-    assert grandfatherson(dts, daily=3) == (keep_dts, prune_dts)
-
-
-def test_grandfatherson_daily_too_few_oldest2():
-    dts = [
-        datetime(2022, 5, 5, 10, 0, 0),
-        datetime(2022, 5, 5, 8, 0, 0),
-    ]
-    assert grandfatherson(dts, daily=3) == (dts, [])
-
-
-def test_grandfatherson_monthly():
-    dts = [
-        datetime(2022, 5, 5, 0, 0, 0),
-        datetime(2022, 5, 4, 0, 0, 0),
-        datetime(2022, 5, 2, 0, 0, 0),
-        datetime(2022, 5, 1, 0, 0, 0),
-        datetime(2022, 4, 20, 0, 0, 0),
-        datetime(2022, 4, 10, 0, 0, 0),
-        datetime(2022, 3, 8, 0, 0, 0),
-        datetime(2022, 3, 7, 0, 0, 0),
-        datetime(2022, 2, 8, 0, 0, 0),
-    ]
-    keep_dts = [dts[0], dts[3], dts[5], dts[7]]
-    prune_dts = [dts[1], dts[2], dts[4], dts[6], dts[8]]
-    assert grandfatherson(dts, monthly=3) == (keep_dts, prune_dts)
-
-
-def test_grandfatherson_weekly():
-    dts = [
-        datetime(2022, 6, 13, 0, 0, 0),
-        datetime(2022, 6, 12, 0, 0, 0),
-        datetime(2022, 6, 11, 0, 0, 0),
-        datetime(2022, 6, 7, 0, 0, 0),
-        datetime(2022, 6, 6, 0, 0, 0),
-        datetime(2022, 6, 5, 0, 0, 0),
-        datetime(2022, 5, 29, 0, 0, 0),
-        datetime(2022, 5, 30, 0, 0, 0),
-    ]
-    keep_dts, prune_dts = grandfatherson(dts, weekly=3)
-    assert keep_dts == [dts[0], dts[4], dts[7]]
-    assert prune_dts == [dts[1], dts[2], dts[3], dts[5], dts[6]]
+import pytest
+
+from backup import (
+    _get_borg_archives,
+    _is_mounted,
+    _list_btrfs_subvolumes,
+    grandfatherson,
+    load_config,
+    parse_suffix,
+    run_lines,
+    run_parallel,
+    truncate_datetime,
+)
+
+DTS_DAILY = [
+    datetime(2022, 5, 5, 0, 0, 0),
+    datetime(2022, 5, 4, 0, 0, 0),
+    datetime(2022, 5, 2, 0, 0, 0),
+    datetime(2022, 5, 1, 0, 0, 0),
+]
+
+DTS_TENMINUTELY = [
+    datetime(2022, 5, 5, 17, 30, 0),
+    datetime(2022, 5, 5, 17, 25, 0),
+    datetime(2022, 5, 5, 17, 20, 0),
+    datetime(2022, 5, 5, 16, 55, 0),
+    datetime(2022, 5, 5, 16, 50, 0),
+    datetime(2022, 5, 5, 16, 40, 0),
+    datetime(2022, 5, 5, 16, 30, 0),
+]
+
+DTS_HOURLY = [
+    datetime(2022, 5, 8, 0, 0, 0),
+    datetime(2022, 5, 5, 17, 0, 0),
+    datetime(2022, 5, 5, 16, 30, 0),
+    datetime(2022, 5, 5, 16, 0, 0),
+    datetime(2022, 5, 5, 15, 0, 0),
+]
+
+DTS_DAILY_HOURS = [
+    datetime(2022, 5, 5, 10, 0, 0),
+    datetime(2022, 5, 4, 10, 0, 0),
+    datetime(2022, 5, 4, 9, 0, 0),
+    datetime(2022, 5, 2, 10, 0, 0),
+    datetime(2022, 5, 1, 10, 0, 0),
+]
+
+DTS_DAILY_TOO_FEW = [
+    datetime(2022, 5, 5, 0, 0, 0),
+    datetime(2022, 5, 4, 0, 0, 0),
+]
+
+DTS_DAILY_TOO_FEW_OLDEST1 = [
+    datetime(2022, 5, 5, 10, 0, 0),
+    datetime(2022, 5, 4, 10, 0, 0),
+    datetime(2022, 5, 4, 9, 0, 0),
+]
+
+DTS_DAILY_TOO_FEW_OLDEST2 = [
+    datetime(2022, 5, 5, 10, 0, 0),
+    datetime(2022, 5, 5, 8, 0, 0),
+]
+
+DTS_MONTHLY = [
+    datetime(2022, 5, 5, 0, 0, 0),
+    datetime(2022, 5, 4, 0, 0, 0),
+    datetime(2022, 5, 2, 0, 0, 0),
+    datetime(2022, 5, 1, 0, 0, 0),
+    datetime(2022, 4, 20, 0, 0, 0),
+    datetime(2022, 4, 10, 0, 0, 0),
+    datetime(2022, 3, 8, 0, 0, 0),
+    datetime(2022, 3, 7, 0, 0, 0),
+    datetime(2022, 2, 8, 0, 0, 0),
+]
+
+DTS_WEEKLY = [
+    datetime(2022, 6, 13, 0, 0, 0),
+    datetime(2022, 6, 12, 0, 0, 0),
+    datetime(2022, 6, 11, 0, 0, 0),
+    datetime(2022, 6, 7, 0, 0, 0),
+    datetime(2022, 6, 6, 0, 0, 0),
+    datetime(2022, 6, 5, 0, 0, 0),
+    datetime(2022, 5, 29, 0, 0, 0),
+    datetime(2022, 5, 30, 0, 0, 0),
+]
+
+
+def _as_tuples(dts: Iterable[datetime]) -> list[tuple[int, ...]]:
+    """Convert (naive) datetimes to tuples of integers, which are cheaper to compare."""
+    return [(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second) for dt in dts]
+
+
+@pytest.mark.parametrize(
+    ("dts", "kwargs", "keep_indices", "prune_indices"),
+    [
+        pytest.param([], {"daily": 3}, [], [], id="empty"),
+        pytest.param(DTS_DAILY, {}, [0], [1, 2, 3], id="none"),
+        pytest.param(
+            DTS_TENMINUTELY, {"tenminutely": 3}, [0, 2, 4, 5], [1, 3, 6], id="tenminutely"
+        ),
+        pytest.param(DTS_HOURLY, {"hourly": 3}, [0, 1, 3], [2, 4], id="hourly"),
+        pytest.param(DTS_DAILY, {"daily": 3}, [0, 1, 2], [3], id="daily1"),
+        pytest.param(DTS_DAILY_HOURS, {"daily": 3}, [0, 2, 3], [1, 4], id="daily2"),
+        pytest.param(DTS_DAILY_TOO_FEW, {"daily": 3}, [0, 1], [], id="daily_too_few"),
+        pytest.param(
+            DTS_DAILY_TOO_FEW_OLDEST1, {"daily": 3}, [0, 2], [1], id="daily_too_few_oldest1"
+        ),
+        pytest.param(
+            DTS_DAILY_TOO_FEW_OLDEST2, {"daily": 3}, [0, 1], [], id="daily_too_few_oldest2"
+        ),
+        pytest.param(DTS_DAILY_HOURS, {"daily": -1}, [0, 2, 3, 4], [1], id="daily_all"),
+        pytest.param(DTS_MONTHLY, {"monthly": 3}, [0, 3, 5, 7], [1, 2, 4, 6, 8], id="monthly"),
+        pytest.param(DTS_WEEKLY, {"weekly": 3}, [0, 4, 7], [1, 2, 3, 5, 6], id="weekly"),
+    ],
+)
+def test_grandfatherson(dts, kwargs, keep_indices, prune_indices):
+    keep_dts, prune_dts = grandfatherson(dts, **kwargs)
+    assert _as_tuples(keep_dts) == _as_tuples(dts[i] for i in keep_indices)
+    assert _as_tuples(prune_dts) == _as_tuples(dts[i] for i in prune_indices)
+
+
+BTRFS_LIST = [
+    b"ID 256 gen 9 top level 5 path @home\n",
+    b"ID 257 gen 10 top level 5 path snap_2022_05_04__17_30_05\n",
+    b"ID 258 gen 11 top level 5 path old snap_2022_05_05__17_30_05\n",
+    b"ID 259 gen 12 top level 5 path snap_current x\n",
+    b"ID 260 gen 13 top level 5 path snapx2022\n",
+    b"ID 261 gen 14 top level 5 path snap.2022\n",
+    b"   \n",
+    b"\n",
+]
+
+
+def _fake_run_lines(monkeypatch, lines: list[bytes]):
+    """Let run_lines yield the given lines instead of running a command."""
+    monkeypatch.setattr("backup.run_lines", lambda cmd, **kwargs: iter(lines))
+
+
+@pytest.mark.parametrize(
+    ("prefix", "subvols"),
+    [
+        # The last word of each line is the path, also when it contains a space.
+        (
+            "snap_",
+            ["snap_2022_05_04__17_30_05", "snap_2022_05_05__17_30_05"],
+        ),
+        (
+            "",
+            [
+                "@home",
+                "snap_2022_05_04__17_30_05",
+                "snap_2022_05_05__17_30_05",
+                "x",
+                "snapx2022",
+                "snap.2022",
+            ],
+        ),
+        # Regex metacharacters in the prefix are matched literally.
+        ("snap.", ["snap.2022"]),
+        ("@", ["@home"]),
+        ("snap+", []),
+    ],
+)
+def test_list_btrfs_subvolumes(monkeypatch, prefix, subvols):
+    monkeypatch.setattr("backup.btrfsutil", None)
+    _fake_run_lines(monkeypatch, BTRFS_LIST)
+    assert list(_list_btrfs_subvolumes("/mnt/", prefix)) == subvols
+
+
+@pytest.mark.parametrize(
+    ("prefix", "lines", "archives"),
+    [
+        (
+            "host-",
+            [
+                b"host-2022_05_04__17_30_05    Wed, 2022-05-04 17:30:05 [0123abcd]\n",
+                b"  \n",
+                b"host-2022_05_05__17_30_05 Thu, 2022-05-05 17:30:05 [4567abcd]\n",
+            ],
+            {
+                datetime(2022, 5, 4, 17, 30, 5): "host-2022_05_04__17_30_05",
+                datetime(2022, 5, 5, 17, 30, 5): "host-2022_05_05__17_30_05",
+            },
+        ),
+        (
+            "",
+            [b"2022_05_04__17_30_05 Wed, 2022-05-04 17:30:05 [0123abcd]\n", b"\n"],
+            {datetime(2022, 5, 4, 17, 30, 5): "2022_05_04__17_30_05"},
+        ),
+        (
+            "h.st+",
+            [b"h.st+2022_05_04__17_30_05 Wed, 2022-05-04 17:30:05 [0123abcd]\n"],
+            {datetime(2022, 5, 4, 17, 30, 5): "h.st+2022_05_04__17_30_05"},
+        ),
+    ],
+)
+def test_get_borg_archives(monkeypatch, prefix, lines, archives):
+    _fake_run_lines(monkeypatch, lines)
+    config = {"borg": {"prefix": prefix}, "datetime_format": "%Y_%m_%d__%H_%M_%S"}
+    assert _get_borg_archives(config, "repo", {}) == archives
+
+
+@pytest.mark.parametrize("archive", [b"other-2022_05_04__17_30_05", b"hxst+2022_05_04__17_30_05"])
+def test_get_borg_archives_wrong_prefix(monkeypatch, archive):
+    _fake_run_lines(monkeypatch, [archive + b" Wed, 2022-05-04 17:30:05 [0123abcd]\n"])
+    config = {"borg": {"prefix": "h.st+"}, "datetime_format": "%Y_%m_%d__%H_%M_%S"}
+    message = f"Archive '{archive.decode()}' has the wrong prefix"
+    with pytest.raises(AssertionError, match=re.escape(message)):
+        _get_borg_archives(config, "repo", {})
+
+
+def test_load_config(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    fn_config = tmp_path / "config.yaml"
+    fn_config.write_text("keep_daily: 14\nborg:\n  repositories: []\n")
+    config = {"keep_daily": 14, "borg": {"repositories": []}}
+    assert load_config(fn_config) == config
+    assert len(os.listdir(tmp_path / "cache" / "backup-script")) == 1
+    # Second time, the cached copy is used.
+    assert load_config(fn_config) == config
+    # After modification, the YAML file is parsed again.
+    fn_config.write_text("keep_daily: 7\nborg:\n  repositories: []\n")
+    assert load_config(fn_config)["keep_daily"] == 7
+    assert len(os.listdir(tmp_path / "cache" / "backup-script")) == 1
+    # A damaged cache file is ignored and replaced.
+    (fn_cache,) = (tmp_path / "cache" / "backup-script").iterdir()
+    fn_cache.write_text("[1, 2")
+    assert load_config(fn_config)["keep_daily"] == 7
+    assert json.loads(fn_cache.read_text())["config"]["keep_daily"] == 7
+
+
+@pytest.mark.parametrize("cache_home", ["", "cache"])
+def test_load_config_cache_home(tmp_path, monkeypatch, cache_home):
+    monkeypatch.setenv("XDG_CACHE_HOME", cache_home)
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.yaml").write_text("keep_daily: 14\n")
+    assert load_config("config.yaml") == {"keep_daily": 14}
+    assert len(os.listdir(tmp_path / "home" / ".cache" / "backup-script")) == 1
+    assert not (tmp_path / "backup-script").exists()
+    assert not (tmp_path / "cache").exists()
+
+
+def test_load_config_private(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    fn_config = tmp_path / "config.yaml"
+    fn_config.write_text("borg:\n  env:\n    BORG_PASSPHRASE: secret\n")
+    fn_config.chmod(0o600)
+    load_config(fn_config)
+    dn_cache = tmp_path / "cache" / "backup-script"
+    assert dn_cache.stat().st_mode & 0o777 == 0o700
+    (fn_cache,) = dn_cache.iterdir()
+    assert fn_cache.stat().st_mode & 0o777 == 0o600
+    # A cache file that others could have modified is ignored.
+    cache = json.loads(fn_cache.read_text())
+    cache["config"]["borg"]["env"]["BORG_PASSPHRASE"] = "changed"
+    fn_cache.write_text(json.dumps(cache))
+    fn_cache.chmod(0o620)
+    assert load_config(fn_config)["borg"]["env"]["BORG_PASSPHRASE"] == "secret"
+    # The same holds for the cache directory.
+    fn_cache.write_text(json.dumps(cache))
+    fn_cache.chmod(0o600)
+    dn_cache.chmod(0o707)
+    assert load_config(fn_config)["borg"]["env"]["BORG_PASSPHRASE"] == "secret"
+    assert json.loads(fn_cache.read_text()) == cache
+
+
+def test_load_config_sidecar(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    fn_config = tmp_path / "config.yaml"
+    fn_config.write_text("keep_daily: 14\n")
+    assert load_config(str(fn_config), sidecar=True) == {"keep_daily": 14}
+    fn_json = tmp_path / "config.yaml.json"
+    assert json.loads(fn_json.read_text()) == {"keep_daily": 14}
+    # The JSON file is used as long as it is not older than the YAML file.
+    fn_json.write_text('{"keep_daily": 7}')
+    assert load_config(str(fn_config), sidecar=True) == {"keep_daily": 7}
+    os.utime(fn_json, (0, 0))
+    assert load_config(str(fn_config), sidecar=True) == {"keep_daily": 14}
+
+
+def test_load_config_sidecar_private(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    fn_config = tmp_path / "config.yaml"
+    fn_config.write_text("borg:\n  env:\n    BORG_PASSPHRASE: secret\n")
+    fn_config.chmod(0o600)
+    load_config(str(fn_config), sidecar=True)
+    assert (tmp_path / "config.yaml.json").stat().st_mode & 0o777 == 0o600
+
+
+def test_load_config_sidecar_cleanup(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    fn_config = tmp_path / "config.yaml"
+    fn_config.write_text("keep_daily: 14\n")
+    # Replacing the JSON file fails when a directory is in the way.
+    (tmp_path / "config.yaml.json").mkdir()
+    assert load_config(str(fn_config), sidecar=True) == {"keep_daily": 14}
+    assert sorted(os.listdir(tmp_path)) == ["cache", "config.yaml", "config.yaml.json"]
+
+
+def test_load_config_sidecar_relative(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.yaml").write_text("keep_daily: 14\n")
+    assert load_config("config.yaml", sidecar=True) == {"keep_daily": 14}
+    assert json.loads((tmp_path / "config.yaml.json").read_text()) == {"keep_daily": 14}
+
+
+@pytest.mark.parametrize(
+    ("suffix", "datetime_format", "dt"),
+    [
+        ("2022_05_04__17_30_05", "%Y_%m_%d__%H_%M_%S", datetime(2022, 5, 4, 17, 30, 5)),
+        ("2022-05-04", "%Y-%m-%d", datetime(2022, 5, 4)),
+        ("100%_2022.05.04", "100%%_%Y.%m.%d", datetime(2022, 5, 4)),
+        ("04May2022", "%d%b%Y", datetime(2022, 5, 4)),
+    ],
+)
+def test_parse_suffix(suffix, datetime_format, dt):
+    assert parse_suffix(suffix, datetime_format) == dt
+
+
+@pytest.mark.parametrize(
+    "suffix", ["2022_05_04__17_30", "2022_13_04__17_30_05", "2022_+5_04__17_30_05", "foo"]
+)
+def test_parse_suffix_invalid(suffix):
+    with pytest.raises(ValueError):
+        parse_suffix(suffix, "%Y_%m_%d__%H_%M_%S")
+
+
+@pytest.mark.parametrize(
+    ("datetime_format", "dt"),
+    [
+        ("%Y_%m_%d__%H_%M_%S", datetime(2022, 5, 4, 17, 30, 5)),
+        ("%Y_%m_%d", datetime(2022, 5, 4)),
+        ("%Y-%m-%d %H", datetime(2022, 5, 4, 17)),
+        ("%Y-%j", datetime(2022, 5, 4)),
+    ],
+)
+def test_truncate_datetime(datetime_format, dt):
+    dt_now = datetime(2022, 5, 4, 17, 30, 5, 123456)
+    dt_truncated = truncate_datetime(dt_now, datetime_format)
+    assert dt_truncated == dt
+    assert dt_truncated == parse_suffix(dt_now.strftime(datetime_format), datetime_format)
+
+
+def test_is_mounted(tmp_path):
+    assert _is_mounted("/")
+    assert not _is_mounted(tmp_path)
+    # Mount points are compared after resolving symbolic links.
+    (tmp_path / "root").symlink_to("/")
+    assert _is_mounted(tmp_path / "root")
+
+
+@pytest.mark.parametrize(
+    ("grep", "lines"),
+    [
+        (None, ["a b\n", "c d\n", "ab\n"]),
+        (" d", ["c d\n"]),
+        # The exit code 1 of grep (no lines selected) is not an error.
+        ("zz", []),
+    ],
+)
+def test_run_lines(grep, lines):
+    assert list(run_lines(["printf", "a b\nc d\nab\n"], grep=grep)) == lines
+
+
+def test_run_lines_bytes():
+    assert list(run_lines(["printf", "a\nb\n"], grep="b", encoding=None)) == [b"b\n"]
+
+
+def test_run_lines_grep_binary(monkeypatch):
+    monkeypatch.setenv("LC_ALL", "C.UTF-8")
+    lines = run_lines(["printf", "a\\377b\\nc\\n"], grep="a", encoding=None)
+    assert list(lines) == [b"a\xffb\n"]
+
+
+@pytest.mark.parametrize("grep", [None, "x"])
+def test_run_lines_fail(grep):
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        list(run_lines(["sh", "-c", "echo x; exit 3"], grep=grep))
+    assert excinfo.value.returncode == 3
+    assert excinfo.value.cmd[0] == "sh"
+
+
+def test_run_lines_grep_fail(tmp_path, monkeypatch):
+    fn_grep = tmp_path / "grep"
+    fn_grep.write_text("#!/bin/sh\nexit 2\n")
+    fn_grep.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        # The command is killed by SIGPIPE if it writes after grep has exited.
+        list(run_lines(["yes"], grep="x"))
+    assert excinfo.value.returncode == 2
+    assert excinfo.value.cmd[0] == "grep"
+
+
+def test_run_parallel(tmp_path):
+    fn_done = tmp_path / "done"
+    cmds = [["sh", "-c", "exit 1"], ["sh", "-c", f"sleep 0.2; touch {fn_done}"]]
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        run_parallel(cmds)
+    assert excinfo.value.returncode == 1
+    # The failure is only raised after all commands have finished.
+    assert fn_done.is_file()
+
+
+def test_run_parallel_dry_run(tmp_path):
+    fn_done = tmp_path / "done"
+    run_parallel([["touch", str(fn_done)]], dry_run=True)
+    assert not fn_done.exists()